@@ -0,0 +1,82 @@
+"""Numeric kernels behind CostEngine — JIT-compiled with numba when it is installed."""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; NumPy's C loops are the fallback
+    njit = None
+
+
+Totals = list[tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+
+def _group_totals_np(codes: list[np.ndarray], sizes: list[int], credits: np.ndarray,
+                     bytes_: np.ndarray) -> Totals:
+    """Per dimension: (credit sums, byte sums, row counts) indexed by group code."""
+    totals = []
+    for c, n in zip(codes, sizes):
+        # Bytes are summed as int64: bincount's float64 weights lose precision past 2**53.
+        bts = np.zeros(n, dtype=np.int64)
+        np.add.at(bts, c, bytes_)
+        totals.append((np.bincount(c, weights=credits, minlength=n), bts,
+                       np.bincount(c, minlength=n)))
+    return totals
+
+
+def _zscores_np(costs: np.ndarray) -> np.ndarray:
+    return (costs - costs.mean()) / costs.std(ddof=1)
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _group_totals_jit(codes, credits, bytes_, n_groups):
+        sums = np.zeros(n_groups)
+        bts = np.zeros(n_groups, dtype=np.int64)
+        counts = np.zeros(n_groups, dtype=np.int64)
+        # Row-major over queries: each credits/bytes value is read once for all dimensions.
+        for i in range(credits.size):
+            c, b = credits[i], bytes_[i]
+            for d in range(codes.shape[0]):
+                g = codes[d, i]
+                sums[g] += c
+                bts[g] += b
+                counts[g] += 1
+        return sums, bts, counts
+
+    @njit(cache=True, fastmath=True)
+    def _zscores_jit(costs):
+        n = costs.size
+        mu = 0.0
+        for i in range(n):
+            mu += costs[i]
+        mu /= n
+        ss = 0.0
+        for i in range(n):
+            ss += (costs[i] - mu) ** 2
+        sd = np.sqrt(ss / (n - 1))
+        out = np.empty(n)
+        for i in range(n):
+            out[i] = (costs[i] - mu) / sd
+        return out
+
+    def _group_totals_fused(codes: list[np.ndarray], sizes: list[int], credits: np.ndarray,
+                            bytes_: np.ndarray) -> Totals:
+        # Shift each dimension's codes into its own slice of one shared output so the
+        # JIT loop reads each credits/bytes value once for all dimensions.
+        offsets = np.cumsum([0, *sizes])
+        stacked = np.stack([c + off for c, off in zip(codes, offsets)])
+        sums, bts, counts = _group_totals_jit(stacked, credits, bytes_, int(offsets[-1]))
+        return [(sums[lo:hi], bts[lo:hi], counts[lo:hi])
+                for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+    group_totals = _group_totals_fused
+    zscores = _zscores_jit
+else:
+    group_totals = _group_totals_np
+    zscores = _zscores_np
+
+
+def warm_up() -> None:
+    """Compile (or load from cache) the kernels for the dtypes CostEngine passes in."""
+    group_totals([np.zeros(1, dtype=np.intp)], [1], np.zeros(1), np.zeros(1, dtype=np.int64))
+    zscores(np.arange(3, dtype=np.float64))
@@ -0,0 +1,24 @@
+"""Gunicorn settings for serving the WareCost API with multiple uvicorn workers.
+
+CostEngine work is CPU-bound under the GIL, so throughput scales with processes,
+not threads: ``gunicorn -c gunicorn_conf.py api:app``.
+"""
+import os
+
+import _kernels
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+worker_class = "uvicorn_worker.UvicornWorker"
+# Import the app (numpy, pydantic models) once in the master and fork; workers share
+# those pages copy-on-write. api.py keeps no shared mutable state besides the
+# per-process engine cache, which is empty at fork time.
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+keepalive = 5
+
+
+def when_ready(server):
+    # numba compiles lazily on first call; do it in the master so forked workers
+    # inherit compiled kernels instead of each paying for it on its first request.
+    _kernels.warm_up()
@@ -1,9 +1,17 @@
 """Tests for WareCost — cost attribution, anomaly detection, budget enforcement, API."""
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
 import pytest
+from click.testing import CliRunner
 from fastapi.testclient import TestClient
 
-from warecost import CostEngine, QueryRecord
-from api import app
+import _kernels
+from warecost import CostEngine, QueryRecord, cli
+import api
+from api import AnalyzeRequest, _build_engine, app
 
 SAMPLE = [
     {"query_id": "q1", "query_text": "SELECT * FROM orders",
@@ -42,6 +50,42 @@ def test_query_record_dag_extraction():
     assert q.team == "ml"
     assert q.dag_id == "daily_train"
     assert q.dbt_model is None
+    assert q.cost_usd == pytest.approx(0.9)
+
+
+def test_query_tag_whitespace_and_model_key():
+    q = QueryRecord(**{**SAMPLE[0], "query_tag": " team = finance ; model=dim_users ;dag=etl"})
+    assert q.team == "finance"
+    assert q.dbt_model == "dim_users"
+    assert q.dag_id == "etl"
+
+
+def test_query_tag_key_variants():
+    def tagged(tag):
+        return QueryRecord(**{**SAMPLE[0], "query_tag": tag})
+
+    assert tagged("team=a;team=b").team == "a"
+    q = tagged("team:a;dbt=m1;dag:d1")
+    assert (q.team, q.dbt_model, q.dag_id) == ("a", "m1", "d1")
+    assert tagged("model:m2").dbt_model == "m2"
+    assert tagged("dag=etl,v2;team=a").dag_id == "etl,v2"
+
+
+def test_query_record_is_slotted():
+    q = QueryRecord(**SAMPLE[0])
+    assert not hasattr(q, "__dict__")
+    with pytest.raises(AttributeError):
+        setattr(q, "extra", "x")
+
+
+def test_record_cost_matches_engine_price():
+    engine = CostEngine(credit_price=2.0)
+    engine.load(SAMPLE)
+    assert engine.queries[2].cost_usd == 30.0
+    assert engine.anomalies(1.0)[0]["cost_usd"] == 30.0
+    r = client.post("/v1/anomalies", json={"queries": SAMPLE, "credit_price": 2.0,
+                                           "z_threshold": 1.0})
+    assert r.json()["anomalies"][0]["cost_usd"] == 30.0
 
 
 def test_unattributed_team_fallback():
@@ -58,6 +102,63 @@ def test_cost_engine_breakdown_by_team():
     assert by_team["analytics"]["cost_usd"] == 52.5
 
 
+def test_breakdown_sorted_by_credits_with_unattributed_bucket():
+    engine = CostEngine()
+    engine.load(SAMPLE)
+    by_model = engine.breakdown("dbt_model")
+    assert list(by_model) == ["fct_revenue", "stg_orders", "unattributed"]
+    assert by_model["unattributed"]["queries"] == 2
+    assert by_model["fct_revenue"]["bytes"] == 50_000_000
+    assert CostEngine().breakdown("team") == {}
+
+
+def test_breakdowns_match_single_dimension_calls():
+    fused = CostEngine()
+    fused.load(SAMPLE)
+    grouped = fused.breakdowns(["team", "warehouse_name", "dag_id"])
+    single = CostEngine()
+    single.load(SAMPLE)
+    for dim, result in grouped.items():
+        assert result == single.breakdown(dim)
+    assert fused.breakdown("team") == grouped["team"]
+
+
+def test_breakdown_bytes_sum_exactly_past_float_precision():
+    rows = [{**SAMPLE[0], "query_id": f"b{i}", "bytes_scanned": b}
+            for i, b in enumerate([2**53, 1, 1, 1])]
+    engine = CostEngine()
+    engine.load(rows)
+    assert engine.breakdown("team")["analytics"]["bytes"] == 2**53 + 3
+
+
+def test_breakdown_ties_keep_first_appearance_order():
+    rows = [{**SAMPLE[0], "query_id": f"t{i}", "warehouse_name": wh, "credits_used": 1.0}
+            for i, wh in enumerate(["WH_C", "WH_A", "WH_B", "WH_A"])]
+    engine = CostEngine()
+    engine.load(rows)
+    assert list(engine.breakdown("warehouse_name")) == ["WH_A", "WH_C", "WH_B"]
+
+
+def test_breakdown_cache_reset_on_load():
+    engine = CostEngine()
+    engine.load(SAMPLE)
+    first = engine.breakdown("team")
+    assert engine.breakdown("team") == first
+    engine.load(SAMPLE[:1])
+    assert engine.breakdown("team") == {"analytics": {
+        "queries": 1, "credits": 2.5, "cost_usd": 7.5, "bytes": 1_000_000}}
+
+
+def test_cached_results_not_mutable_by_callers():
+    engine = CostEngine()
+    engine.load(SAMPLE)
+    engine.breakdown("team")["analytics"]["queries"] = 99
+    engine.summary()["by_team"].clear()
+    engine.anomalies(1.0).append({"query_id": "junk"})
+    assert engine.breakdown("team")["analytics"]["queries"] == 2
+    assert [a["query_id"] for a in engine.anomalies(1.0)] == ["q3"]
+
+
 def test_anomaly_detection_catches_spike():
     engine = CostEngine()
     engine.load(SAMPLE)
@@ -66,6 +167,32 @@ def test_anomaly_detection_catches_spike():
     assert anoms[0]["query_id"] == "q3"
 
 
+def test_anomalies_across_thresholds_match_direct_filter():
+    rows = [{**SAMPLE[0], "query_id": f"r{i}", "credits_used": c}
+            for i, c in enumerate([1.0, 9.0, 2.0, 9.0, 30.0, 0.5, 4.0])]
+    engine = CostEngine()
+    engine.load(rows)
+    costs = np.array([r["credits_used"] for r in rows]) * 3.0
+    z = (costs - costs.mean()) / costs.std(ddof=1)
+    for thresh in (3.0, 1.0, 0.0, -0.5, -5.0):
+        ids = [a["query_id"] for a in engine.anomalies(thresh)]
+        expected = [f"r{i}" for i in sorted(np.flatnonzero(z > thresh), key=lambda i: -z[i])]
+        assert ids == expected
+    assert engine.anomalies(0.0)[0] == {"query_id": "r4", "cost_usd": 90.0,
+                                        "z_score": round(float(z[4]), 2),
+                                        "team": "analytics", "warehouse": "ANALYTICS_WH"}
+
+
+def test_anomalies_nan_threshold_matches_nothing():
+    engine = CostEngine()
+    engine.load(SAMPLE)
+    assert engine.anomalies(float("nan")) == []
+    r = client.post("/v1/anomalies", content=b'{"queries": %s, "z_threshold": NaN}'
+                    % json.dumps(SAMPLE).encode(), headers={"Content-Type": "application/json"})
+    assert r.status_code == 200
+    assert r.json() == {"anomalies": []}
+
+
 def test_anomaly_none_when_uniform():
     uniform = [{**SAMPLE[0], "query_id": f"u{i}", "credits_used": 1.0} for i in range(5)]
     engine = CostEngine()
@@ -73,6 +200,41 @@ def test_anomaly_none_when_uniform():
     assert engine.anomalies() == []
 
 
+def test_anomaly_none_when_uniform_fractional_credits():
+    uniform = [{**SAMPLE[0], "query_id": f"u{i}", "credits_used": 0.1} for i in range(7)]
+    engine = CostEngine()
+    engine.load(uniform)
+    assert engine.anomalies(z_thresh=0.0) == []
+
+
+def test_numpy_kernels():
+    codes = [np.array([0, 2, 0, 1, 2]), np.array([0, 0, 1, 1, 1])]
+    credits = np.array([1.5, 2.0, 0.5, 4.0, 1.0])
+    bts = np.array([10, 20, 30, 40, 50])
+    (sums, bytes_out, counts), (sums2, _, counts2) = _kernels._group_totals_np(
+        codes, [4, 2], credits, bts)
+    assert sums.tolist() == [2.0, 4.0, 3.0, 0.0]
+    assert bytes_out.tolist() == [40, 40, 70, 0]
+    assert counts.tolist() == [2, 1, 2, 0]
+    assert (sums2.tolist(), counts2.tolist()) == ([3.5, 5.5], [2, 3])
+    costs = np.array([1.0, 2.0, 3.0, 10.0])
+    expected = (costs - costs.mean()) / costs.std(ddof=1)
+    assert _kernels._zscores_np(costs) == pytest.approx(expected)
+
+
+def test_jit_kernels_match_numpy():
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(0)
+    codes = [rng.integers(0, 7, 1000), rng.integers(0, 3, 1000)]
+    credits = rng.exponential(size=1000)
+    bts = rng.integers(0, 10**9, 1000)
+    fused = _kernels._group_totals_fused(codes, [7, 3], credits, bts)
+    for jit, ref in zip(fused, _kernels._group_totals_np(codes, [7, 3], credits, bts)):
+        for a, b in zip(jit, ref):
+            assert a == pytest.approx(b)
+    assert _kernels._zscores_jit(credits) == pytest.approx(_kernels._zscores_np(credits))
+
+
 def test_budget_alert_over():
     engine = CostEngine()
     engine.load(SAMPLE)
@@ -90,6 +252,14 @@ def test_budget_no_alert_when_under():
     assert engine.budget_alerts() == []
 
 
+def test_budget_alerts_uses_given_breakdown():
+    engine = CostEngine()
+    engine.load(SAMPLE)
+    engine.set_budget("analytics", 50.0)
+    alerts = engine.budget_alerts({"analytics": {"cost_usd": 10.0}})
+    assert alerts == []
+
+
 def test_summary_totals():
     engine = CostEngine()
     engine.load(SAMPLE)
@@ -98,6 +268,25 @@ def test_summary_totals():
     assert s["total_cost_usd"] == 53.7
 
 
+def test_cli_analyze_streams_file(tmp_path):
+    path = tmp_path / "queries.json"
+    path.write_text(json.dumps(SAMPLE))
+    result = CliRunner().invoke(cli, ["analyze", str(path), "--budget", "analytics:50"])
+    assert result.exit_code == 0, result.output
+    assert "4 queries analyzed" in result.output
+    assert "$53.7" in result.output
+    assert "[OVER]" in result.output
+
+
+@pytest.mark.parametrize("content", ['{"queries": []}', "[{", ""])
+def test_cli_analyze_rejects_non_array_input(tmp_path, content):
+    path = tmp_path / "queries.json"
+    path.write_text(content)
+    result = CliRunner().invoke(cli, ["analyze", str(path)])
+    assert result.exit_code != 0
+    assert "0 queries analyzed" not in result.output
+
+
 client = TestClient(app)
 
 
@@ -115,6 +304,13 @@ def test_api_analyze_full():
     assert len(data["budget_alerts"]) == 1
 
 
+def test_api_analyze_totals_only():
+    r = client.post("/v1/analyze?include_anomalies=false&include_breakdown=false"
+                    "&include_budget=false", json={"queries": SAMPLE})
+    assert r.status_code == 200
+    assert set(r.json()) == {"total_queries", "total_credits", "total_cost_usd"}
+
+
 def test_api_breakdown_team():
     r = client.post("/v1/breakdown/team", json={"queries": SAMPLE})
     assert r.status_code == 200
@@ -124,3 +320,54 @@ def test_api_breakdown_team():
 def test_api_invalid_dimension():
     r = client.post("/v1/breakdown/invalid", json={"queries": SAMPLE})
     assert r.status_code == 400
+
+
+def test_api_invalid_query_data_is_422():
+    r = client.post("/v1/anomalies", json={"queries": [{"query_id": "q1"}]})
+    assert r.status_code == 422
+    assert any(e["loc"][-1] == "credits_used" for e in r.json()["detail"])
+
+
+def test_api_ignores_extra_query_fields():
+    rows = [{**q, "warehouse_size": "XSMALL"} for q in SAMPLE]
+    r = client.post("/v1/breakdown/warehouse_name", json={"queries": rows})
+    assert r.status_code == 200
+    assert r.json()["breakdown"]["ANALYTICS_WH"]["queries"] == 2
+
+
+def test_build_engine_reused_for_identical_payload():
+    def build(payload):
+        return _build_engine(AnalyzeRequest(**payload), json.dumps(payload).encode())
+
+    engine = build({"queries": SAMPLE, "budgets": {"analytics": 50}})
+    assert build({"queries": SAMPLE, "budgets": {"analytics": 50}}) is engine
+    assert build({"queries": SAMPLE, "budgets": {"analytics": 60}}) is not engine
+    assert build({"queries": SAMPLE, "budgets": {"analytics": 50},
+                  "credit_price": 2.0}).credit_price == 2.0
+
+
+def test_api_gzips_large_responses():
+    rows = [{**SAMPLE[0], "query_id": f"g{i}", "user_name": f"team{i}_x", "query_tag": ""}
+            for i in range(50)]
+    r = client.post("/v1/breakdown/team", json={"queries": rows},
+                    headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    assert len(r.json()["breakdown"]) == 50
+    small = client.get("/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+
+def test_expired_engines_evicted_on_insert(monkeypatch):
+    monkeypatch.setattr(api, "_ENGINE_CACHE_TTL", 0.05)
+    monkeypatch.setattr(api, "_engine_cache", OrderedDict())
+
+    def build(price):
+        payload = {"queries": SAMPLE, "credit_price": price}
+        return _build_engine(AnalyzeRequest(**payload), json.dumps(payload).encode())
+
+    build(1.0)
+    time.sleep(0.06)
+    build(2.0)
+    build(4.0)
+    assert [e.credit_price for _, e in api._engine_cache.values()] == [2.0, 4.0]
@@ -1,16 +1,38 @@
 """WareCost — Data warehouse query cost attribution & budget enforcement engine."""
-import json
-import statistics
+import re
 import sys
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable, Optional
 
 import click
+import ijson
+import numpy as np
 from rich.console import Console
 from rich.table import Table
 
+from _kernels import group_totals, zscores
 
-@dataclass
+
+_TAG_RE = re.compile(r"(?:^|;)\s*(team|dag|dbt|model)\s*[=:]\s*([^;]*)")
+
+
+@lru_cache(maxsize=4096)
+def _parse_tag(query_tag: str) -> dict[str, str]:
+    """Extract attribution keys from a ``team=x;dbt:model`` query tag in one regex sweep.
+
+    Recognized keys are ``team``, ``dag``, ``dbt`` and ``model``, each with either ``=``
+    or ``:`` as separator; segments split on ``;``. The first occurrence of a key wins.
+    Tags repeat heavily across a query history (one per dbt model / DAG task), so
+    results are memoized; callers must treat the returned dict as read-only.
+    """
+    tags: dict[str, str] = {}
+    for m in _TAG_RE.finditer(query_tag):
+        tags.setdefault(m.group(1), m.group(2).strip())
+    return tags
+
+
+@dataclass(slots=True)
 class QueryRecord:
     query_id: str
     query_text: str
@@ -21,29 +43,21 @@ class QueryRecord:
     execution_time_ms: int
     start_time: str
     query_tag: str = ""
-
-    def _extract(self, prefix: str) -> Optional[str]:
-        if prefix in self.query_tag:
-            return self.query_tag.split(prefix)[1].split(";")[0].strip()
-        return None
-
-    @property
-    def team(self) -> str:
-        return self._extract("team=") or (
+    credit_price: float = 3.0
+    # Derived attribution, computed once in __post_init__ rather than on every access.
+    team: str = field(init=False)
+    dbt_model: Optional[str] = field(init=False)
+    dag_id: Optional[str] = field(init=False)
+    cost_usd: float = field(init=False)
+
+    def __post_init__(self):
+        tags = _parse_tag(self.query_tag)
+        self.team = tags.get("team") or (
             self.user_name.split("_")[0] if "_" in self.user_name else "unattributed"
         )
-
-    @property
-    def dbt_model(self) -> Optional[str]:
-        return self._extract("dbt:") or self._extract("model=")
-
-    @property
-    def dag_id(self) -> Optional[str]:
-        return self._extract("dag=")
-
-    @property
-    def cost_usd(self) -> float:
-        return round(self.credits_used * 3.0, 4)
+        self.dbt_model = tags.get("dbt") or tags.get("model")
+        self.dag_id = tags.get("dag")
+        self.cost_usd = self.credits_used * self.credit_price
 
 
 class CostEngine:
@@ -51,46 +65,109 @@ class CostEngine:
         self.credit_price = credit_price
         self.queries: list[QueryRecord] = []
         self.budgets: dict[str, float] = {}
+        self._credits = np.zeros(0, dtype=np.float64)
+        self._bytes = np.zeros(0, dtype=np.int64)
+        self._costs = np.zeros(0, dtype=np.float64)
+        self._dims: dict[str, tuple[list[str], np.ndarray]] = {}
+        self._breakdown_cache: dict[str, dict] = {}
+        self._z_rank: Optional[tuple[np.ndarray, np.ndarray]] = None
 
     def load(self, records: list[dict]) -> int:
-        self.queries = [QueryRecord(**r) for r in records]
-        return len(self.queries)
+        return self.load_iter(records)
+
+    def load_iter(self, records: Iterable[dict]) -> int:
+        """Load from any iterable of row dicts, e.g. a streaming JSON parser."""
+        price = self.credit_price
+        return self.load_records([QueryRecord(**r, credit_price=price) for r in records])
+
+    def load_records(self, queries: list[QueryRecord]) -> int:
+        """Load prebuilt records; build them with ``credit_price=self.credit_price``."""
+        self.queries = queries
+        n = len(self.queries)
+        self._credits = np.fromiter((q.credits_used for q in self.queries), dtype=np.float64, count=n)
+        self._bytes = np.fromiter((q.bytes_scanned for q in self.queries), dtype=np.int64, count=n)
+        self._costs = self._credits * self.credit_price
+        self._dims = {}
+        self._breakdown_cache.clear()
+        self._z_rank = None
+        return n
+
+    def _dim(self, dim: str) -> tuple[list[str], np.ndarray]:
+        # Categorical encoding of a dimension: distinct labels plus one int code per query,
+        # so grouping compares ints instead of hashing strings. Built once per load.
+        if dim not in self._dims:
+            table: dict[str, int] = {}
+            codes = np.fromiter(
+                (table.setdefault(getattr(q, dim, None) or "unattributed", len(table))
+                 for q in self.queries), dtype=np.intp, count=len(self.queries))
+            self._dims[dim] = (list(table), codes)
+        return self._dims[dim]
 
     def set_budget(self, team: str, amount: float):
         self.budgets[team] = amount
+        self._breakdown_cache.clear()
 
     def breakdown(self, dim: str) -> dict:
-        groups: dict[str, list[QueryRecord]] = {}
-        for q in self.queries:
-            key = getattr(q, dim, None) or "unattributed"
-            groups.setdefault(key, []).append(q)
+        return self.breakdowns([dim])[dim]
+
+    def breakdowns(self, dims: list[str]) -> dict[str, dict]:
+        """Break down by several dimensions in one fused pass over the credit/byte columns."""
+        todo = [d for d in dict.fromkeys(dims) if d not in self._breakdown_cache]
+        if todo:
+            encoded = [self._dim(d) for d in todo]
+            totals = group_totals([c for _, c in encoded], [len(labels) for labels, _ in encoded],
+                                  self._credits, self._bytes)
+            for d, (labels, _), (credits, bts, counts) in zip(todo, encoded, totals):
+                self._breakdown_cache[d] = self._format_groups(labels, credits, bts, counts)
+        # Hand out copies so callers can't mutate what later calls (and shared API engines) see.
+        return {d: {k: dict(v) for k, v in self._breakdown_cache[d].items()} for d in dims}
+
+    def _format_groups(self, labels: list[str], credits: np.ndarray, bts: np.ndarray,
+                       counts: np.ndarray) -> dict:
         result = {}
-        for k, qs in sorted(groups.items(), key=lambda x: -sum(q.credits_used for q in x[1])):
-            tc = sum(q.credits_used for q in qs)
-            result[k] = {
-                "queries": len(qs), "credits": round(tc, 4),
+        # Codes are numbered in first-appearance order, so a stable sort keeps equal-cost
+        # groups in the order they first appear in the history.
+        for i in np.argsort(-credits, kind="stable"):
+            tc = float(credits[i])
+            result[labels[i]] = {
+                "queries": int(counts[i]), "credits": round(tc, 4),
                 "cost_usd": round(tc * self.credit_price, 2),
-                "bytes": sum(q.bytes_scanned for q in qs),
+                "bytes": int(bts[i]),
             }
         return result
 
+    def _z_ranking(self) -> tuple[np.ndarray, np.ndarray]:
+        """Query indices by descending z-score, plus the negated z-scores in that order.
+
+        Computed once per load so anomalies() at any threshold is a binary search.
+        """
+        if self._z_rank is None:
+            order, neg_z = np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float64)
+            # Uniform costs have no outliers. Checked with one min/max pass (exact, unlike a
+            # float std of identical values) before paying for mean/std/argsort.
+            if self._costs.size >= 3 and np.ptp(self._costs) > 0:
+                neg_z = -zscores(self._costs)
+                order = np.argsort(neg_z, kind="stable")
+                neg_z = neg_z[order]
+            self._z_rank = (order, neg_z)
+        return self._z_rank
+
     def anomalies(self, z_thresh: float = 2.0) -> list[dict]:
-        if len(self.queries) < 3:
-            return []
-        costs = [q.cost_usd for q in self.queries]
-        mu, sd = statistics.mean(costs), statistics.stdev(costs)
-        if sd == 0:
+        if np.isnan(z_thresh):  # z > nan is never true; searchsorted would return every row
             return []
-        return sorted(
-            [{"query_id": q.query_id, "cost_usd": q.cost_usd,
-              "z_score": round((q.cost_usd - mu) / sd, 2),
-              "team": q.team, "warehouse": q.warehouse_name}
-             for q in self.queries if (q.cost_usd - mu) / sd > z_thresh],
-            key=lambda x: -x["z_score"],
-        )
+        order, neg_z = self._z_ranking()
+        k = int(np.searchsorted(neg_z, -z_thresh, side="left"))
+        result = []
+        for i, nz in zip(order[:k], neg_z[:k]):
+            q = self.queries[i]
+            result.append({"query_id": q.query_id, "cost_usd": round(float(self._costs[i]), 4),
+                           "z_score": round(-float(nz), 2),
+                           "team": q.team, "warehouse": q.warehouse_name})
+        return result
 
-    def budget_alerts(self) -> list[dict]:
-        by_team = self.breakdown("team")
+    def budget_alerts(self, by_team: Optional[dict] = None) -> list[dict]:
+        if by_team is None:
+            by_team = self.breakdown("team")
         alerts = []
         for team, limit in self.budgets.items():
             spent = by_team.get(team, {}).get("cost_usd", 0)
@@ -100,18 +177,38 @@ class CostEngine:
                                "pct": pct, "status": "OVER" if pct >= 100 else "WARNING"})
         return alerts
 
-    def summary(self) -> dict:
+    def summary(self, include_anomalies: bool = True, include_breakdown: bool = True,
+                include_budget: bool = True) -> dict:
         tc = sum(q.credits_used for q in self.queries)
-        return {"total_queries": len(self.queries), "total_credits": round(tc, 4),
-                "total_cost_usd": round(tc * self.credit_price, 2),
-                "by_team": self.breakdown("team"),
-                "by_warehouse": self.breakdown("warehouse_name"),
-                "anomalies": self.anomalies(), "budget_alerts": self.budget_alerts()}
+        report: dict = {"total_queries": len(self.queries), "total_credits": round(tc, 4),
+                        "total_cost_usd": round(tc * self.credit_price, 2)}
+        by_team = None
+        if include_breakdown:
+            grouped = self.breakdowns(["team", "warehouse_name"])
+            by_team = grouped["team"]
+            report["by_team"] = by_team
+            report["by_warehouse"] = grouped["warehouse_name"]
+        if include_anomalies:
+            report["anomalies"] = self.anomalies()
+        if include_budget:
+            report["budget_alerts"] = self.budget_alerts(by_team)
+        return report
 
 
 console = Console()
 
 
+def _stream_rows(f) -> Iterable[dict]:
+    """Stream rows from a top-level JSON array without parsing the whole document."""
+    while (ch := f.read(1)) and ch.isspace():
+        pass
+    if ch != b"[":
+        raise click.ClickException("Expected a top-level JSON array of query rows")
+    f.seek(0)
+    # Hand ijson the file itself so its C backend builds the row dicts.
+    return ijson.items(f, "item", use_float=True)
+
+
 @click.group()
 def cli():
     """WareCost — Data warehouse query cost attribution."""
@@ -123,8 +220,12 @@ def cli():
 def analyze(file: str, budget: tuple[str, ...]):
     """Analyze query history from a JSON file."""
     engine = CostEngine()
-    with open(file) as f:
-        n = engine.load(json.load(f))
+    with open(file, "rb") as f:
+        # Stream rows so the full JSON tree never sits in memory next to the records.
+        try:
+            n = engine.load_iter(_stream_rows(f))
+        except ijson.JSONError as exc:
+            raise click.ClickException(f"Invalid JSON: {exc}") from exc
     for b in budget:
         t, a = b.split(":")
         engine.set_budget(t.strip(), float(a))